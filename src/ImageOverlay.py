@@ -1,6 +1,41 @@
 from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+from functools import lru_cache
 from os import path
 
+@lru_cache(maxsize=None)
+def load_font(font, font_size):
+    """
+    Loads a TrueType font, cached per (font path, size) so it is only parsed once.
+    
+    Parameters:
+        font (str): Path to the font file
+        font_size (int): Font size in pixels
+        
+    Returns:
+        ImageFont.FreeTypeFont: The loaded font
+    """
+    return ImageFont.truetype(font, font_size)
+
+@lru_cache(maxsize=None)
+def render_text(font, font_size, text):
+    """
+    Rasterizes text once into a glyph mask, cached per (font path, size, text).
+    
+    Parameters:
+        font (str): Path to the font file
+        font_size (int): Font size in pixels
+        text (str): The string to render
+        
+    Returns:
+        tuple: (Image, tuple, float) - (L mode glyph mask, (x,y) offset of the mask from the text origin, text length)
+    """
+    font = load_font(font, font_size)
+    left, top, right, bottom = font.getbbox(text)
+    mask = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+    return mask, (left, top), font.getlength(text)
+
 class ImageOverlay:
     """
     A class to handle text overlay operations on images.
@@ -15,6 +50,8 @@ class ImageOverlay:
         shadow_color (tuple, optional): RGBA color tuple for the shadow
         shadow_offset (tuple, optional): (x,y) offset for the shadow
     """
+    max_overlay_layers = 4  # Full-frame layers kept by prepare, least recently used ones are dropped first
+
     def __init__(self, image_file_name, font, bg_tint_color=(0, 0, 0), bg_transparency=0, text_color=None, draw_shadow=False, shadow_color=(0, 0, 0, 128), shadow_offset=(5, 5)):
         self.image_file_name = image_file_name
         self.font = font
@@ -25,6 +62,7 @@ class ImageOverlay:
         self.shadow_color = shadow_color 
         self.shadow_offset = shadow_offset
         self.image = None
+        self.overlay_layers = {}  # Recently rendered overlay layers keyed by (text positions, image size)
 
     def load_image(self):
         """
@@ -39,61 +77,82 @@ class ImageOverlay:
         self.image = Image.open(self.image_file_name).convert("RGBA")
         return True
 
-    def overlay_text(self, text_positions):
+    def prepare(self, text_positions, image_size):
         """
-        Overlays text on the image at specified positions.
+        Renders the RGBA text overlay layer for the given positions and image size.
+        The last max_overlay_layers layers are cached on the instance, so images of the same size
+        and positions (e.g. the phases of an animation) only need to be composited.
         
         Parameters:
-            text_positions (list): List of tuples containing (x_ratio, y_ratio, text)
-                where x_ratio and y_ratio are float values between 0-1 representing
-                the relative position on the image, and text is the string to display
-                
+            text_positions (list): List of tuples containing (x_ratio, y_ratio, text), see overlay_text
+            image_size (tuple): (width, height) of the images the layer is applied to
+            
         Returns:
-            tuple: (bool, str) - (success status, output filename if successful or error message)
+            Image: The RGBA overlay layer
         """
-        if self.image is None:
-            return False, "Image not loaded."
+        key = (tuple(text_positions), image_size)
+        if key in self.overlay_layers:
+            overlay = self.overlay_layers.pop(key)
+            self.overlay_layers[key] = overlay  # Move to the most recently used end
+            return overlay
 
-        try:
-            overlay = Image.new('RGBA', self.image.size, self.bg_tint_color + (0,))
-            draw = ImageDraw.Draw(overlay)  # Create a context for drawing things on it.
+        overlay = Image.new('RGBA', image_size, self.bg_tint_color + (0,))
+        draw = ImageDraw.Draw(overlay)  # Create a context for drawing things on it.
 
-            image_width, image_height = self.image.size
+        image_width, image_height = image_size
 
-            # Calculate font size based on image height
-            font_size = int(image_height * 0.05)  # 5% of the image height
-            font = ImageFont.truetype(self.font, font_size)
+        # Calculate font size based on image height
+        font_size = int(image_height * 0.05)  # 5% of the image height
 
-            for position in text_positions:
-                x_ratio, y_ratio, text = position  # Unpack the position tuple
-                x = int(x_ratio * image_width)  # Calculate absolute x position
-                y = int(y_ratio * image_height)  # Calculate absolute y position
+        for position in text_positions:
+            x_ratio, y_ratio, text = position  # Unpack the position tuple
+            x = int(x_ratio * image_width)  # Calculate absolute x position
+            y = int(y_ratio * image_height)  # Calculate absolute y position
 
-                # Calculate text dimensions
-                text_width = draw.textlength(text=text, font=font)
-                text_height = font_size  # Use the calculated font size for height
+            # Calculate text dimensions
+            text_mask, (mask_x, mask_y), text_width = render_text(self.font, font_size, text)
+            text_height = font_size  # Use the calculated font size for height
 
-                # Center the text
-                centered_x = x - (text_width // 2)
-                centered_y = y - (text_height // 2)
+            # Center the text
+            centered_x = x - (text_width // 2)
+            centered_y = y - (text_height // 2)
 
-                # Draw shadow if enabled
-                if self.draw_shadow:
-                    shadow_x = centered_x + self.shadow_offset[0]
-                    shadow_y = centered_y + self.shadow_offset[1]
-                    draw.text((shadow_x, shadow_y), text, fill=self.shadow_color, font=font)
+            # Draw shadow if enabled
+            if self.draw_shadow:
+                shadow_x = centered_x + self.shadow_offset[0]
+                shadow_y = centered_y + self.shadow_offset[1]
+                overlay.paste(self.shadow_color, (int(shadow_x) + mask_x, int(shadow_y) + mask_y), text_mask)
 
-                # Draw a rectangle behind the text
-                draw.rectangle((centered_x, centered_y, centered_x + text_width, centered_y + text_height), fill=self.bg_tint_color + (int(255 * self.bg_transparency),))
+            # Draw a rectangle behind the text
+            draw.rectangle((centered_x, centered_y, centered_x + text_width, centered_y + text_height), fill=self.bg_tint_color + (int(255 * self.bg_transparency),))
 
-                # Draw the text with the specified text color
-                draw.text((centered_x, centered_y), text, fill=self.text_color, font=font)
+            # Draw the text with the specified text color
+            overlay.paste(self.text_color or (255, 255, 255, 255), (int(centered_x) + mask_x, int(centered_y) + mask_y), text_mask)
 
+        if len(self.overlay_layers) >= self.max_overlay_layers:
+            del self.overlay_layers[next(iter(self.overlay_layers))]
+        self.overlay_layers[key] = overlay
+        return overlay
+
+    def overlay_text(self, text_positions):
+        """
+        Overlays text on the image at specified positions.
+        
+        Parameters:
+            text_positions (list): List of tuples containing (x_ratio, y_ratio, text)
+                where x_ratio and y_ratio are float values between 0-1 representing
+                the relative position on the image, and text is the string to display
+                
+        Returns:
+            tuple: (bool, numpy.ndarray | str) - (success status, HxWx3 RGB overlayed frame if successful or error message)
+        """
+        if self.image is None:
+            return False, "Image not loaded."
+
+        try:
+            overlay = self.prepare(text_positions, self.image.size)
             img = Image.alpha_composite(self.image, overlay)
-            output_file_name = path.splitext(self.image_file_name)[0] + "_overlay.png"
-            img.save(output_file_name)
-            print(f"Overlay image saved as: {output_file_name}")
-            return True, output_file_name
+            return True, np.asarray(img.convert("RGB"))
             
         except Exception as e:
             error_msg = f"Error during overlay: {str(e)}"
@@ -119,6 +178,10 @@ if __name__ == "__main__":
     overlay_instance = ImageOverlay(image, font, bg_tint_color, bg_transparency, text_color, draw_shadow=True)
     if overlay_instance.load_image():
         success, result = overlay_instance.overlay_text(text_positions)
-        if not success:
+        if success:
+            output_file_name = path.splitext(image)[0] + "_overlay.png"
+            Image.fromarray(result).save(output_file_name)
+            print(f"Overlay image saved as: {output_file_name}")
+        else:
             print(f"Failed to create overlay: {result}")
 
@@ -1,17 +1,22 @@
 import pandas as pd
 import numpy as np
-import math
 import cv2
-from moviepy import VideoFileClip, concatenate_videoclips
+import re
+import subprocess
+import tempfile
+from bisect import bisect_right
+from os import path
+from moviepy.config import FFMPEG_BINARY
 
 class VideoClipper:
     def __init__(self, video_file, h5_file):
         self.video_file = video_file
         self.h5_file = h5_file
-        self.df = pd.read_hdf(h5_file)
+        self.bodyparts, self.xs, self.ys = self.load_pose_data(h5_file)
         self.fps = self.get_video_fps(video_file)
         self.speeds = []
         self.interesting_frames = []
+        self.merged_intervals = []
 
     def get_video_fps(self, video_file):
         """Get the fps of the video"""
@@ -24,105 +29,190 @@ class VideoClipper:
         
         return fps
 
-    def calculate_speed(self, bodyparts):
-        """Calculates the average speed of specified body parts."""
-        speeds = []
+    def load_pose_data(self, h5_file):
+        """Loads the pose estimation data as contiguous (n_frames, n_parts) x and y arrays."""
+        df = pd.read_hdf(h5_file)
         individuals = 'animal0' # hardcoded, assumpution is that only 1 pet in the video, therefore the coordinates of the first animal are used
-        scorer = self.df.columns.get_level_values('scorer')[0]  # The column name of the first level of df
-        
-        for i in range(1, len(self.df)):  # Start from the second frame
-            frame1 = self.df.iloc[i-1]
-            frame2 = self.df.iloc[i]
-            total_displacement = 0
-            valid_parts = 0  # Count body parts with valid data
-
-            for part in bodyparts:
-                x1 = frame1[(scorer, individuals, part, 'x')]
-                y1 = frame1[(scorer, individuals, part, 'y')]
-                x2 = frame2[(scorer, individuals, part, 'x')]
-                y2 = frame2[(scorer, individuals, part, 'y')]
-
-                # Check for NaN values (missing data)
-                if not np.any(np.isnan([x1, y1, x2, y2])):
-                    displacement = math.dist((x1, y1), (x2, y2))
-                    total_displacement += displacement
-                    valid_parts += 1
-
-            if valid_parts > 0:
-                avg_displacement = total_displacement / valid_parts
-            else:
-                avg_displacement = 0  # Handle the case where no parts have valid data
+        scorer = df.columns.get_level_values('scorer')[0]  # The column name of the first level of df
+        animal = df[scorer][individuals]
+
+        xs = animal.xs('x', level='coords', axis=1)
+        ys = animal.xs('y', level='coords', axis=1)[xs.columns]  # Same body part order as xs
+        return list(xs.columns), xs.to_numpy(dtype=np.float32, copy=True), ys.to_numpy(dtype=np.float32, copy=True)
+
+    def calculate_speed(self, bodyparts=None):
+        """Calculates the average speed of specified body parts (all body parts by default)."""
+        xs, ys = self.xs, self.ys
+        if bodyparts is not None:
+            part_indices = [self.bodyparts.index(part) for part in bodyparts]
+            xs, ys = xs[:, part_indices], ys[:, part_indices]
+
+        # Displacement of every body part between consecutive frames, computed in place
+        dx = np.diff(xs, axis=0)
+        dy = np.diff(ys, axis=0)
+        displacements = np.hypot(dx, dy, out=dx)
 
-            speed = avg_displacement / (1 / self.fps)
-            speeds.append(speed)
+        # Average over body parts with valid data, NaN (missing data) is skipped
+        valid_parts = ~np.isnan(displacements)
+        valid_counts = np.count_nonzero(valid_parts, axis=1)
+        total_displacement = np.sum(displacements, axis=1, where=valid_parts)
+        avg_displacement = np.divide(total_displacement, valid_counts, out=np.zeros_like(total_displacement), where=valid_counts > 0)  # 0 where no parts have valid data
 
-        self.speeds = speeds
+        self.speeds = (avg_displacement * self.fps).tolist()
 
     def identify_high_speed_frames(self, std_multiplier=2, window_size=5):
         """Identifies interesting frames using an adaptive threshold (mean + std)."""
-        rolling_avg_speeds = pd.Series(self.speeds).rolling(window=window_size).mean().fillna(0).tolist()
+        # Rolling average over window_size frames from a cumulative sum, 0 until the window is full
+        speeds = np.asarray(self.speeds, dtype=np.float64)
+        cumulative_speeds = np.concatenate(([0.0], np.cumsum(speeds)))
+        rolling_avg_speeds = np.zeros_like(speeds)
+        rolling_avg_speeds[window_size - 1:] = (cumulative_speeds[window_size:] - cumulative_speeds[:-window_size]) / window_size
+
         mean_speed = np.mean(rolling_avg_speeds)
         std_speed = np.std(rolling_avg_speeds)
         speed_threshold = mean_speed + std_multiplier * std_speed
 
-        interesting_frames = []
-        for i, speed in enumerate(rolling_avg_speeds):
-            if speed > speed_threshold:
-                frame_number = i + 1
-                interesting_frames.append((frame_number, f"Speed: {speed:.2f}"))
-        self.interesting_frames = interesting_frames
-
-    def clip_video_segments(self, buffer_duration=0.2):
-        """Creates and merges clips to avoid repetition."""
-        clips = []
+        high_speed_indices = np.flatnonzero(rolling_avg_speeds > speed_threshold)
+        self.interesting_frames = [
+            (i + 1, f"Speed: {rolling_avg_speeds[i]:.2f}")  # frame_number = i + 1
+            for i in high_speed_indices.tolist()
+        ]
+
+    def get_keyframe_times(self):
+        """Returns the sorted presentation times (s) of the video's keyframes, only keyframes are decoded."""
+        result = subprocess.run(
+            [FFMPEG_BINARY, "-hide_banner", "-nostats", "-skip_frame", "nokey", "-i", self.video_file,
+             "-map", "0:v:0", "-vf", "showinfo", "-f", "null", "-"],
+            capture_output=True, text=True, check=True,
+        )
+        return sorted(float(t) for t in re.findall(r"pts_time:\s*([-\d.]+)", result.stderr))
+
+    def merge_intervals(self, buffer_duration=0.2, keyframe_times=None):
+        """
+        Merges the time windows around the interesting frames to avoid repetition.
+        If keyframe_times is given, window starts are first moved back to the preceding keyframe
+        (where a stream-copy cut really starts), so windows sharing footage are merged.
+        """
         merged_intervals = []  # Store merged time intervals
 
-        for frame_num, reason in self.interesting_frames:
-            start_time = (frame_num - 1) / self.fps - buffer_duration
-            end_time = frame_num / self.fps + buffer_duration
-            start_time = max(0, start_time)  # Ensure start_time is not negative
-
-            current_interval = (start_time, end_time)
-
-            # Check for overlap with existing intervals
-            merged = False
-            for i, (existing_start, existing_end) in enumerate(merged_intervals):
-                if start_time <= existing_end and end_time >= existing_start:  # Overlap detected
-                    # Merge the intervals
-                    merged_intervals[i] = (min(start_time, existing_start), max(end_time, existing_end))
-                    merged = True
-                    break
-
-            if not merged:
-                merged_intervals.append(current_interval)
-
-        # Create clips from the merged intervals
-        for start_time, end_time in merged_intervals:
-            try:
-                clip = VideoFileClip(self.video_file).subclipped(start_time, end_time)
-                clips.append(clip)
-            except Exception as e:
-                print(f"Error creating clip from {start_time:.2f} to {end_time:.2f}: {e}")
-
-        # Concatenate the clips
-        if clips:
-            final_clip = concatenate_videoclips(clips)
-            return final_clip
-        else:
-            print("No valid clips to concatenate.")
-            return None
+        # Time window (with buffer) around each interesting frame, sorted by start time
+        intervals = sorted(
+            (max(0, (frame_num - 1) / self.fps - buffer_duration), frame_num / self.fps + buffer_duration)
+            for frame_num, reason in self.interesting_frames
+        )
+
+        if keyframe_times:
+            intervals = [
+                (keyframe_times[max(bisect_right(keyframe_times, start_time + 1e-6) - 1, 0)], end_time)
+                for start_time, end_time in intervals
+            ]
+
+        # Single sweep merging overlapping intervals
+        for start_time, end_time in intervals:
+            if merged_intervals and start_time <= merged_intervals[-1][1]:  # Overlap detected
+                merged_intervals[-1] = (merged_intervals[-1][0], max(end_time, merged_intervals[-1][1]))
+            else:
+                merged_intervals.append((start_time, end_time))
+
+        self.merged_intervals = merged_intervals
+
+    def segment_frame_ranges(self):
+        """Returns the [start, end) frame ranges of the merged intervals, clipped to the video length."""
+        frame_count = len(self.xs)
+        return [
+            (round(start_time * self.fps), min(round(end_time * self.fps), frame_count))
+            for start_time, end_time in self.merged_intervals
+        ]
+
+    def segment_frame_count(self):
+        """Returns the number of frames in the merged intervals."""
+        return sum(end - start for start, end in self.segment_frame_ranges())
+
+    def iter_segment_frames(self, frame_interval=1, start_frame=0, end_frame=None):
+        """
+        Yields (frame index, RGB frame array) for the merged intervals, decoded with a single reader.
+        Frame indices count through the segments as if they were one clip; start_frame/end_frame
+        select a range of those indices and frame_interval skips frames, like text_overlay.extract_frames.
+        """
+        if end_frame is None:
+            end_frame = self.segment_frame_count()
+
+        cap = cv2.VideoCapture(self.video_file)
+        try:
+            segment_offset = 0  # Clip index of the first frame of the current segment
+            for segment_start, segment_end in self.segment_frame_ranges():
+                first = max(start_frame, segment_offset)
+                last = min(end_frame, segment_offset + segment_end - segment_start)
+                if first < last:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, segment_start + first - segment_offset)
+                    for i in range(first, last):
+                        if i % frame_interval != 0:
+                            # Skipped frames are only grabbed, not retrieved and converted
+                            if not cap.grab():
+                                break
+                            continue
+
+                        ret, frame = cap.read()
+                        if not ret:
+                            break
+
+                        yield i, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+                segment_offset += segment_end - segment_start
+        finally:
+            cap.release()
+
+    def clip_video_segments(self, output_path, buffer_duration=0.2):
+        """
+        Cuts the merged intervals and concatenates them without re-encoding.
+        Stream-copy cuts can only start on a keyframe, so each interval starts at the keyframe preceding it.
+        """
+        self.merge_intervals(buffer_duration=buffer_duration, keyframe_times=self.get_keyframe_times())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Cut each merged interval with stream copy, starts are already on keyframes
+            segments = []
+            for i, (start_time, end_time) in enumerate(self.merged_intervals):
+                segment_path = path.join(tmp_dir, f"segment_{i:04d}.mp4")
+                try:
+                    subprocess.run(
+                        [FFMPEG_BINARY, "-y", "-loglevel", "error",
+                         "-ss", f"{start_time:.6f}", "-i", self.video_file, "-t", f"{end_time - start_time:.6f}",
+                         "-c", "copy", "-avoid_negative_ts", "make_zero", segment_path],
+                        check=True,
+                    )
+                    segments.append(segment_path)
+                except subprocess.CalledProcessError as e:
+                    print(f"Error creating clip from {start_time:.2f} to {end_time:.2f}: {e}")
+
+            if not segments:
+                print("No valid clips to concatenate.")
+                return False
+
+            # Concatenate the segments with the concat demuxer, again without re-encoding
+            list_path = path.join(tmp_dir, "segments.txt")
+            with open(list_path, "w") as f:
+                f.writelines(f"file '{path.abspath(segment_path)}'\n" for segment_path in segments)
+
+            subprocess.run(
+                [FFMPEG_BINARY, "-y", "-loglevel", "error",
+                 "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", output_path],
+                check=True,
+            )
+        return True
+
+    def analyze(self, buffer_duration=0.2, std_multiplier=2, window_size=5):
+        """Finds the interesting frames and merges their time windows, without writing a video."""
+        self.calculate_speed()
+        self.identify_high_speed_frames(std_multiplier=std_multiplier, window_size=window_size)
+        self.merge_intervals(buffer_duration=buffer_duration)
 
     def analyze_and_clip(self, output_filename, buffer_duration=0.2, std_multiplier=2, window_size=5):
         """Main method to perform analysis and create video clips."""
-        all_bodyparts = self.df.columns.get_level_values('bodyparts').unique()
-        self.calculate_speed(all_bodyparts)
+        self.calculate_speed()
         self.identify_high_speed_frames(std_multiplier=std_multiplier, window_size=window_size)
-        final_clip = self.clip_video_segments(buffer_duration=buffer_duration)
 
-        if final_clip:
-            output_path = f"output/{output_filename}"
-            final_clip.write_videofile(output_path, codec="libx264")
-        else:
+        output_path = f"output/{output_filename}"
+        if not self.clip_video_segments(output_path, buffer_duration=buffer_duration):
             print("No video created.")
 
 if __name__ == "__main__":
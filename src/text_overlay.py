@@ -1,131 +1,289 @@
 import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+import torchvision.transforms.functional as TF
 import clip
 from PIL import Image
 import numpy as np
 import cv2
-from os import path, makedirs
+import math
+import subprocess
+from functools import lru_cache, partial
+from itertools import chain
+from os import cpu_count
 from .ImageOverlay import ImageOverlay
-from moviepy.video.io.ImageSequenceClip import ImageSequenceClip
+from moviepy.config import FFMPEG_BINARY
 
-def extract_frames(video_path, output_dir="frames", frame_interval=1):
-    """Extracts frames from the video at a specified interval."""
-    if not path.exists(output_dir):
-        makedirs(output_dir)
+# Normalization constants used by CLIP's own preprocessing
+CLIP_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_STD = (0.26862954, 0.26130258, 0.27577711)
 
+def get_video_info(video_path):
+    """Returns the fps and frame count of the video."""
     cap = cv2.VideoCapture(video_path)
-    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = int(cap.get(cv2.CAP_PROP_FPS))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    return fps, frame_count
 
-    extracted_frames = []  # Store paths to extracted frames
-    
-    for i in range(frame_count):
-        ret, frame = cap.read()
-        if not ret:
-            break
+def extract_frames(video_path, frame_interval=1, start_frame=0, end_frame=None):
+    """Yields (frame index, RGB frame array) from the video at a specified interval."""
+    cap = cv2.VideoCapture(video_path)
+    if end_frame is None:
+        end_frame = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    if start_frame > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
 
-        if i % frame_interval == 0:
-            frame_path = path.join(output_dir, f"frame_{i:06d}.jpg")
-            cv2.imwrite(frame_path, frame)
-            extracted_frames.append(frame_path)
+    try:
+        for i in range(start_frame, end_frame):
+            if i % frame_interval != 0:
+                # Skipped frames are only grabbed, not retrieved and converted
+                if not cap.grab():
+                    break
+                continue
 
-    cap.release()
-    return fps, extracted_frames
+            ret, frame = cap.read()
+            if not ret:
+                break
+
+            yield i, cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    finally:
+        cap.release()
+
+def preprocess_frame(frame, resolution=224):
+    """CLIP resize and center crop of an RGB frame array, returned as a uint8 CHW tensor (normalized later on the device)."""
+    height, width = frame.shape[:2]
+    scale = resolution / min(height, width)
+    resized_width, resized_height = max(resolution, round(width * scale)), max(resolution, round(height * scale))
+    frame = cv2.resize(frame, (resized_width, resized_height), interpolation=cv2.INTER_AREA)
+
+    top, left = (resized_height - resolution) // 2, (resized_width - resolution) // 2
+    frame = frame[top:top + resolution, left:left + resolution]
+    return torch.from_numpy(frame).permute(2, 0, 1)  # HWC -> CHW
+
+def normalize_frames(images, device):
+    """Moves a uint8 batch of preprocessed frames to the device and applies CLIP normalization there."""
+    images = images.to(device, non_blocking=True).float().div_(255)
+    return TF.normalize(images, CLIP_MEAN, CLIP_STD, inplace=True)
+
+class FrameDataset(IterableDataset):
+    """
+    Decodes and CLIP-preprocesses frames, split into contiguous ranges across the DataLoader workers.
+    frame_source(frame_interval, start_frame, end_frame) yields (frame index, RGB frame array) like extract_frames.
+    Yields (frame index, preprocessed frame), frames that fail to preprocess are reported and skipped.
+    """
+    def __init__(self, frame_source, frame_count, preprocess, frame_interval=1):
+        self.frame_source = frame_source
+        self.frame_count = frame_count
+        self.preprocess = preprocess
+        self.frame_interval = frame_interval
+
+    def __iter__(self):
+        frame_count = self.frame_count
+        start_frame, end_frame = 0, frame_count
+
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            frames_per_worker = math.ceil(frame_count / worker_info.num_workers)
+            start_frame = worker_info.id * frames_per_worker
+            end_frame = min(start_frame + frames_per_worker, frame_count)
+
+        frames = self.frame_source(self.frame_interval, start_frame, end_frame)
+        i = start_frame - 1
+        while True:
+            try:
+                i, frame = next(frames)
+            except StopIteration:
+                break
+            except Exception as e:
+                # A failing decoder cannot be resumed, the rest of this worker's range is skipped
+                print(f"Error decoding frames {i + 1}-{end_frame - 1} for similarity: {e}")
+                break
+
+            try:
+                image = self.preprocess(frame)
+            except Exception as e:
+                print(f"Error processing frame {i} for similarity: {e}")
+                continue
+            yield i, image
 
 def load_clip_model(device="cuda" if torch.cuda.is_available() else "cpu"):
-    """Loads the CLIP model and tokenizer."""
-    model, preprocess = clip.load("ViT-B/32", device=device) # can try "ViT-L/14" 
+    """Loads the CLIP model and a preprocess function that takes RGB frame arrays."""
+    model, _ = clip.load("ViT-B/32", device=device) # can try "ViT-L/14" 
+    model.eval()  # clip.load already keeps the weights in fp16 on CUDA
+    preprocess = partial(preprocess_frame, resolution=model.visual.input_resolution)
     return model, preprocess, device
 
-def generate_image_overlays(extracted_frames, model, preprocess, device, caption_options, font, color=(255, 255, 255, 255), bg_tint_color=(0, 0, 0), bg_transparency=0, draw_shadow=True, animate_text=False, animation_interval=5, animation_offset=0.01):
-    """Generates text overlays for each frame using CLIP and ImageOverlay class."""
+def composite_overlay_layers(frames, layers, animation_interval=0):
+    """
+    Composites pre-rendered overlay layers onto (frame index, RGB frame array) pairs, yielding the frames in order.
+    layers holds one (layer, (left, top)) per animation phase, the phase alternates every animation_interval frames
+    (0 means a single phase). Only the frame region covered by the layer is converted and composited.
+    """
+    for i, frame in frames:
+        phase = (i // animation_interval) % len(layers) if animation_interval else 0
+        layer, (left, top) = layers[phase]
+        if layer is not None:
+            region = np.s_[top:top + layer.height, left:left + layer.width]
+            try:
+                composited = Image.alpha_composite(Image.fromarray(frame[region]).convert("RGBA"), layer)
+                frame[region] = np.asarray(composited.convert("RGB"))
+            except Exception as e:
+                print(f"Error processing frame {i}: {e}")
+        yield frame
+
+def generate_image_overlays(frame_source, frame_count, fps, model, preprocess, device, caption_options, font, color=(255, 255, 255, 255), bg_tint_color=(0, 0, 0), bg_transparency=0, draw_shadow=True, animate_text=False, animation_interval=5, animation_offset=0.01, batch_size=64, num_workers=min(8, cpu_count() or 1), clip_stride=None):
+    """
+    Generates text overlays for each frame using CLIP and ImageOverlay class, yielding the overlayed RGB frames.
+    frame_source(frame_interval, start_frame, end_frame) yields (frame index, RGB frame array) like extract_frames,
+    it is called once per pass.
+    """
 
     # Pre-encode caption options
     text = clip.tokenize(caption_options).to(device)
-    with torch.no_grad():
+    with torch.inference_mode():
         text_features = model.encode_text(text)
         text_features /= text_features.norm(dim=-1, keepdim=True)
+        # Keep the normalized features in the model dtype (fp16 on CUDA) so the similarity matmul never upcasts
+        text_features = text_features.to(model.dtype).contiguous()
 
     # Initialize array to store cumulative similarity scores
     cumulative_similarity = np.zeros(len(caption_options))
 
-    # First pass: calculate cumulative similarity scores across all frames
-    for frame_path in extracted_frames:
+    # Only every clip_stride-th frame is scored (default: twice per second), adjacent frames give near-identical similarities
+    if clip_stride is None:
+        clip_stride = max(1, int(fps // 2))
+
+    # First pass: calculate cumulative similarity scores across the sampled frames, one batch at a time
+    # Frames are decoded and resized in memory by DataLoader workers while the model encodes the previous batch,
+    # batches are copied to the device as uint8 and normalized there
+    use_cuda = torch.device(device).type == "cuda"
+    loader = DataLoader(FrameDataset(frame_source, frame_count, preprocess, frame_interval=clip_stride), batch_size=batch_size, num_workers=num_workers, pin_memory=use_cuda)
+    for indices, images in loader:
         try:
-            image = Image.open(frame_path).convert("RGB")
-            image = preprocess(image).unsqueeze(0).to(device)
+            images = normalize_frames(images, device)
 
-            with torch.no_grad():
-                image_features = model.encode_image(image)
+            with torch.inference_mode(), torch.autocast("cuda", dtype=torch.float16, enabled=use_cuda):
+                image_features = model.encode_image(images)
                 image_features /= image_features.norm(dim=-1, keepdim=True)
+                similarity = image_features @ text_features.T
 
-            similarity = (image_features @ text_features.T).squeeze().cpu().numpy()
-            cumulative_similarity += similarity
+            cumulative_similarity += similarity.sum(dim=0).float().cpu().numpy()
         except Exception as e:
-            print(f"Error processing frame {frame_path} for similarity: {e}")
+            print(f"Error processing frames {int(indices[0])}-{int(indices[-1])} for similarity: {e}")
 
     # Find the top 2 captions based on cumulative scores
     top_2_indices = np.argsort(cumulative_similarity)[-2:][::-1]  # Get indices of top 2 scores
     best_captions = [caption_options[i] for i in top_2_indices]
 
-    overlayed_images = []
-
     # Define base text positions
     base_text_positions = [
         (0.2, 0.15, best_captions[0]),  # First caption base position
         (0.8, 0.25, best_captions[1])   # Second caption base position
     ]
 
-    # Second pass: apply the captions to all frames
-    for i, frame_path in enumerate(extracted_frames): # Added index 'i'
-        try:
-            overlay = ImageOverlay(frame_path, font, bg_tint_color, bg_transparency, color, draw_shadow)
-            if overlay.load_image():
-                current_text_positions = base_text_positions
-                if animate_text:
-                    # Calculate offset based on frame index and interval
-                    # Simple alternating horizontal offset for demonstration
-                    offset_factor = ((i // animation_interval) % 2) * 2 - 1 # Alternates between -1 and 1
-                    x_offset = animation_offset * offset_factor
-                    # Apply offset to base positions
-                    current_text_positions = [
-                        (pos[0] + x_offset, pos[1], pos[2]) # Apply horizontal offset
-                        for pos in base_text_positions
-                    ]
-
-                overlay.overlay_text(current_text_positions) # Use potentially offset positions
-                overlayed_images.append(path.splitext(frame_path)[0] + "_overlay.png")
-            else:
-                print(f"Error loading or overlaying image: {frame_path}")
-                overlayed_images.append(frame_path)
-        except Exception as e:
-            print(f"Error processing frame {frame_path}: {e}")
-            overlayed_images.append(frame_path)
+    frames = frame_source()
+    first_frame = next(frames, None)
+    if first_frame is None:
+        return
+    frames = chain([first_frame], frames)
+    image_height, image_width = first_frame[1].shape[:2]
 
-    return overlayed_images
+    # The overlay only depends on the animation phase, so each phase's layer is rendered once here
+    # and cropped to the area it covers. Animation alternates a horizontal offset between -1 and 1
+    overlay = ImageOverlay(None, font, bg_tint_color, bg_transparency, color, draw_shadow)
+    phase_offsets = [-animation_offset, animation_offset] if animate_text else [0]
+    layers = []
+    for x_offset in phase_offsets:
+        text_positions = [
+            (pos[0] + x_offset, pos[1], pos[2]) # Apply horizontal offset
+            for pos in base_text_positions
+        ]
+        layer = overlay.prepare(text_positions, (image_width, image_height))
+        bbox = layer.getbbox()
+        layers.append((layer.crop(bbox), bbox[:2]) if bbox else (None, (0, 0)))
 
-def create_video_from_images(image_paths, output_video="output/output.mp4", fps=25):
-    """Creates a video from a list of images."""
-    clip = ImageSequenceClip(image_paths, fps=fps)
-    clip.write_videofile(output_video, fps=fps, codec="libx264")
+    # Second pass: decode the frames again and composite the captions in memory
+    yield from composite_overlay_layers(frames, layers, animation_interval if animate_text else 0)
 
-def pipeline(video_path, caption_options, font, output_video="output/output.mp4",bg_tint_color=(0, 0, 0), bg_transparency=0, color=(255, 255, 255, 255), draw_shadow=True, animate_text=False, animation_interval=10, animation_offset=0.05):
-    """Main function to run CLIP-based image overlay and video creation."""
+@lru_cache(maxsize=None)
+def ffmpeg_can_encode(encoder):
+    """
+    Checks whether the given encoder actually works by encoding one test frame.
+    Being listed in `ffmpeg -encoders` only means it was compiled in, e.g. NVENC can still fail to open
+    without the driver library, on an unsupported GPU or when the session limit is reached.
+    """
+    result = subprocess.run(
+        [FFMPEG_BINARY, "-hide_banner", "-loglevel", "error",
+         "-f", "lavfi", "-i", "color=s=256x256", "-frames:v", "1",
+         "-c:v", encoder, "-pix_fmt", "yuv420p", "-f", "null", "-"],
+        capture_output=True,
+    )
+    return result.returncode == 0
+
+def video_encoder_args():
+    """ffmpeg H.264 encoder arguments: NVENC when CUDA is available and NVENC can encode, otherwise a fast libx264 preset."""
+    if torch.cuda.is_available() and ffmpeg_can_encode("h264_nvenc"):
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-b:v", "8M"]
+    return ["-c:v", "libx264", "-preset", "veryfast"]  # libx264 already uses all cores by default
+
+def create_video_from_frames(frames, output_video="output/output.mp4", fps=25):
+    """Creates a video by piping RGB frame arrays to ffmpeg."""
+    frames = iter(frames)
+    first_frame = next(frames, None)
+    if first_frame is None:
+        print("No frames to write.")
+        return
+
+    height, width = first_frame.shape[:2]
+    # yuv420p needs even dimensions, odd sized frames get a one pixel pad on the right/bottom edge
+    pad_args = ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"] if width % 2 or height % 2 else []
+    process = subprocess.Popen(
+        [FFMPEG_BINARY, "-y", "-loglevel", "error",
+         "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", f"{width}x{height}", "-r", str(fps), "-i", "-",
+         *pad_args, *video_encoder_args(), "-pix_fmt", "yuv420p", output_video],
+        stdin=subprocess.PIPE,
+    )
+    try:
+        for frame in chain([first_frame], frames):
+            process.stdin.write(frame.tobytes())
+    except BrokenPipeError:
+        pass  # ffmpeg exited early, reported through its return code below
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        process.wait()
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+def pipeline_from_frames(frame_source, frame_count, fps, caption_options, font, output_video="output/output.mp4", bg_tint_color=(0, 0, 0), bg_transparency=0, color=(255, 255, 255, 255), draw_shadow=True, animate_text=False, animation_interval=10, animation_offset=0.05, clip_stride=None):
+    """Runs CLIP-based image overlay and video creation on frames from frame_source (see generate_image_overlays)."""
 
     # 1. Load CLIP model
     model, preprocess, device = load_clip_model()
 
-    # 2. Extract frames
-    fps, extracted_frames = extract_frames(video_path)
-
-    # 3. Generate image overlays
-    overlayed_images = generate_image_overlays(
-        extracted_frames, model, preprocess, device, caption_options, font,
+    # 2. Generate image overlays, frames are decoded on the fly
+    overlayed_frames = generate_image_overlays(
+        frame_source, frame_count, fps, model, preprocess, device, caption_options, font,
         bg_tint_color=bg_tint_color, bg_transparency=bg_transparency, color=color, draw_shadow=draw_shadow,
-        animate_text=animate_text, animation_interval=animation_interval, animation_offset=animation_offset
+        animate_text=animate_text, animation_interval=animation_interval, animation_offset=animation_offset,
+        clip_stride=clip_stride
     )
 
-    # 4. Create video from images
-    create_video_from_images(overlayed_images, output_video=output_video, fps=fps)
+    # 3. Create video from the overlayed frames as they are generated
+    create_video_from_frames(overlayed_frames, output_video=output_video, fps=fps)
+
+def pipeline(video_path, caption_options, font, output_video="output/output.mp4",bg_tint_color=(0, 0, 0), bg_transparency=0, color=(255, 255, 255, 255), draw_shadow=True, animate_text=False, animation_interval=10, animation_offset=0.05, clip_stride=None):
+    """Main function to run CLIP-based image overlay and video creation."""
+    fps, frame_count = get_video_info(video_path)
+    pipeline_from_frames(
+        partial(extract_frames, video_path), frame_count, fps, caption_options, font, output_video,
+        bg_tint_color=bg_tint_color, bg_transparency=bg_transparency, color=color, draw_shadow=draw_shadow,
+        animate_text=animate_text, animation_interval=animation_interval, animation_offset=animation_offset,
+        clip_stride=clip_stride
+    )
 
 if __name__ == "__main__":
     video_path = r"output/interesting_segments_clip.mp4"